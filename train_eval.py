@@ -1,10 +1,93 @@
-import pandas as pd
+import functools
 import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.impute import SimpleImputer
 from sklearn.metrics import accuracy_score
-from sklearn.impute import KNNImputer
+from sklearn.neighbors import NearestNeighbors
+from joblib import Parallel, delayed
+
+"""
+Type: Function
+Name: chunked_predict
+Purpose: Predict with a trained classifier in blocks of rows so that the per-tree vote arrays built by the forest only ever cover one
+         block, which caps peak memory on large inputs. The input is made a C-contiguous float32 array first so that the forest does
+         not take a hidden copy of it
+Parameters: Trained classifier, NumPy array, number of rows per block (Int)
+Output: NumPy array of predicted labels
+"""
+
+def chunked_predict(model, X, chunk = 8192):
+
+    X = np.ascontiguousarray(X, dtype = np.float32)
+
+    if X.shape[0] <= chunk:
+        return model.predict(X)
+
+    return np.concatenate([model.predict(X[i:i + chunk]) for i in range(0, X.shape[0], chunk)])
+
+"""
+Type: Function
+Name: knn_impute
+Purpose: KNN imputation of the items with missing values, equivalent to sklearn's KNNImputer with uniform weights when the
+         training set has no missing values. The items are grouped by which features are missing so that each group can run
+         an exact euclidean neighbour search on its observed features only, then every missing value is filled with the mean
+         of that feature over the neighbours
+Parameters: NumPy array (training set without missing values), NumPy array (items with missing values), number of neighbours (Int)
+Output: Copy of the items with missing values with the missing values filled in
+"""
+
+def knn_impute(x_train, x_missing, n_neighbors = 30):
+
+    x_imputed = x_missing.copy()
+    n_neighbors = min(n_neighbors, x_train.shape[0])
+    patterns, inverse = np.unique(np.isnan(x_missing), axis = 0, return_inverse = True)
+    inverse = inverse.ravel()
+
+    for p, pattern in enumerate(patterns):
+
+        if not pattern.any():
+            continue
+
+        rows = np.flatnonzero(inverse == p)
+        observed = ~pattern
+
+        if not observed.any(): #nothing to measure distance on, fall back to the feature means
+            x_imputed[np.ix_(rows, pattern)] = x_train[:, pattern].mean(axis = 0)
+            continue
+
+        neighbors = NearestNeighbors(n_neighbors = n_neighbors, algorithm = 'brute', n_jobs = -1)
+        neighbors.fit(x_train[:, observed])
+        neighbor_idx = neighbors.kneighbors(x_missing[np.ix_(rows, observed)], return_distance = False)
+        missing_cols = np.flatnonzero(pattern)
+        #gather only the neighbours' values in the missing features, shape (rows, neighbours, missing features), and average them
+        x_imputed[np.ix_(rows, missing_cols)] = x_train[neighbor_idx[:, :, None], missing_cols].mean(axis = 1)
+
+    return x_imputed
+
+"""
+Type: Function
+Name: cached_knn_impute
+Purpose: Memoized knn_impute so that TrainModel instances built on the same split (e.g. the same seed with a different threshold)
+         share one neighbour search. The arrays are keyed by their raw bytes, and the result is returned read-only since it
+         is shared between callers
+Parameters: NumPy array (training set without missing values), NumPy array (items with missing values), number of neighbours (Int)
+Output: Read-only copy of the items with missing values with the missing values filled in
+"""
+
+def cached_knn_impute(x_train, x_missing, n_neighbors = 30):
+
+    return _knn_impute_from_bytes(x_train.tobytes(), x_missing.tobytes(), x_train.dtype.str, x_train.shape[1], n_neighbors)
+
+@functools.lru_cache(maxsize = 4)
+def _knn_impute_from_bytes(x_train_bytes, x_missing_bytes, dtype, n_features, n_neighbors):
+
+    x_train = np.frombuffer(x_train_bytes, dtype = dtype).reshape(-1, n_features)
+    x_missing = np.frombuffer(x_missing_bytes, dtype = dtype).reshape(-1, n_features)
+    x_imputed = knn_impute(x_train, x_missing, n_neighbors)
+    x_imputed.setflags(write = False)
+
+    return x_imputed
 
 """
 Type: Class
@@ -26,10 +109,25 @@ Parameters: None
 Output: Trained random forest classifier
 ---------------------------------------------------------------------------------------------------------------------------------
 Type: Function
+Name: _impute_missing
+Purpose: Fill the missing values of the items with missing values using a per-feature statistic of the training set, computed
+         for all features with missing values at once
+Parameters: NumPy reduction (np.nanmean or np.nanmedian)
+Output: New array of x_missing with the missing values filled in
+---------------------------------------------------------------------------------------------------------------------------------
+Type: Function
+Name: _eval_A, _eval_B, _eval_C, _eval_D, _eval_E, _eval_F
+Purpose: Evaluate the model with a single method of handling the items with missing values (abstention, majority class imputation,
+         omit features with missing values, mean imputation, median imputation and KNN imputation respectively). Each function only
+         reads the data and the trained model so that they can be run in parallel
+Parameters: None
+Output: Tuple of the accuracy on the entire test set and the accuracy on the items with missing values
+---------------------------------------------------------------------------------------------------------------------------------
+Type: Function
 Name: evaluate_model
 Purpose: Evaludate the model by using the test set which contains items with missing values in one or more features. 
          The methods used for abstention, majority class imputation, omit features with missing values, using the mean to 
-         imput, using the median to imput and using KNN imputation
+         imput, using the median to imput and using KNN imputation. The methods are run in parallel
 Parameters: None
 Output: 2 dictionaries of accuracies, one using the entire test set and one only using the items with missing values
 """
@@ -41,37 +139,44 @@ class TrainModel:
         self.data = data
         self.threshold = threshold
         self.random_seed = random_seed
-        self.model = RandomForestClassifier(random_state = random_seed)
+        self.model = RandomForestClassifier(random_state = random_seed, n_jobs = -1) #trees are fit and queried in parallel on all cores
         self.x_train = None
         self.y_train = None
         self.x_test = None
         self.y_test = None
         self.x_missing = None
         self.y_missing = None
+        self.y_test_full = None
+        self.y_pred_test = None
         self.missing = None
+        self.majority_class = None
         self.accuracy_dict_entire_test_set = {}
         self.accuracy_dict_missing_values = {}
         self.feature_labels = None
         self.columns_missing = None
+        self.missing_col_idx = None
+        self.keep_col_idx = None
 
     def load_data(self):
 
-        data = self.data.copy() #create a copy of the data so that we do not modify the original data in any way
-        feature_labels = data.columns.tolist()
-        feature_labels.pop(0)
+        data = self.data #only read from below, so the original data is never modified
+        feature_labels = list(data.columns[1:]) #the first column is the truth label
         self.feature_labels = feature_labels
-        Xy = data.to_numpy()
-        X = Xy[:,1:]
+        Xy = data.to_numpy(copy = False)
+        X = np.ascontiguousarray(Xy[:,1:], dtype = np.float32) #the forest works in float32 internally, so convert once here
         y = (Xy[:,0] >= self.threshold).astype(int) #sets to 0 if star and 1 if galaxy
-        missing = np.sum(np.isnan(X), axis = 1) > 0
+        nan_mask = np.isnan(X) #a single scan of X gives both the rows and the features with missing values
+        missing = nan_mask.any(axis = 1) #rows with a missing value in any feature
+        col_missing = nan_mask.any(axis = 0)
         self.x_train, self.x_test, self.y_train, self.y_test = \
             train_test_split(X[~missing], y[~missing], train_size = 3000, random_state = self.random_seed) #only use the items with no missing values
         self.x_missing = X[missing]
         self.y_missing = y[missing]
         self.missing = missing
-        missing_values = data.isnull().any()
-        columns_missing = data.columns[missing_values].tolist()
-        self.columns_missing = columns_missing
+        self.majority_class = int(np.bincount(self.y_train).argmax()) #majority class of the training set, used by method B
+        self.columns_missing = [label for label, flag in zip(feature_labels, col_missing) if flag]
+        self.missing_col_idx = np.flatnonzero(col_missing) #positions of those columns in X
+        self.keep_col_idx = np.flatnonzero(~col_missing) #features kept by method C
 
     def train_model(self):
 
@@ -79,192 +184,106 @@ class TrainModel:
 
         return self.model
 
-    def evaluate_model(self):
-        
-        method = ['A','B','C','D','E','F'] #create a simple list so that we can iterate through each method one at a time
-
-        for method in method:
-
-            x_test = self.x_test.copy() #generate a copy of test x and y
-            y_test = self.y_test.copy()
-            x_missing = self.x_missing.copy() #generate a copy of test x and y with missing values
-            y_missing = self.y_missing.copy()
-            
-            if method == 'A': #method: Abstention
-
-                y_test_full = np.concatenate((y_test, y_missing)) #concatenate y test and y with missing items
-                y_pred = self.model.predict(x_test) 
-                num_missing_items = x_missing.shape[0]
-                y_pred_missing = np.full((num_missing_items,), -1)
-                y_pred_full = np.concatenate((y_pred, y_pred_missing))
-            
-                accuracy = accuracy_score(y_test_full, y_pred_full)
-                self.accuracy_dict_entire_test_set[method] = accuracy
-
-                #because items with missing values are treated as errors, we can ignore it and give it a 0.0 accuracy
-                missing_items_array = np.full((num_missing_items, ), -1) 
-                accuracy_missing = accuracy_score(y_missing, missing_items_array)
-                self.accuracy_dict_missing_values[method] = accuracy_missing
-
-                print("Method A succeeded")
-            
-            if method == 'B': #majority inference
-
-                majority_class = np.bincount(self.y_train).argmax() #gets the majority class here
-
-                #create a new np array that is of dimension y_missing but filled with the majority class label
-                y_pred_majority = np.full_like(y_missing, fill_value = majority_class) 
-                y_pred_non_missing = self.model.predict(x_test)
-                y_pred = np.concatenate((y_pred_non_missing, y_pred_majority))
-                accuracy = accuracy_score(y_test_full, y_pred)
-                self.accuracy_dict_entire_test_set[method] = accuracy
-
-                #missing only now
-                #we compare y_pred_majority predictions with y_missing
-                accuracy_missing = accuracy_score(y_missing, y_pred_majority)
-                self.accuracy_dict_missing_values[method] = accuracy_missing
-
-                print("Method B succeeded")
-            
-            if method == 'C':
-            # omit any features with missing values (based on report generated, the features to be eliminated should be
-            # )
-                x_test_full = np.concatenate((x_test, x_missing))
-                y_test_full = np.concatenate((y_test, y_missing))
-                labels_C = self.feature_labels.copy()
-                rebuilt_x_test = pd.DataFrame(x_test_full, columns = labels_C)
-                rebuilt_x_test = rebuilt_x_test.drop(columns = self.columns_missing, axis = 1) #omitting features with missing values here from the testing set
-                x_train = self.x_train.copy()
-                y_train = self.y_train.copy() 
-                #shouldn't require a copy for y_train, but for the sake of the next two methods, 
-                #we'll use copy to prevent accidental modifications to the base truth label set
-                rebuilt_x_train = pd.DataFrame(x_train, columns = labels_C)
-                rebuilt_x_train = rebuilt_x_train.drop(columns = self.columns_missing, axis = 1) #omitting from training set
-                model = RandomForestClassifier(random_state = self.random_seed)
-                model.fit(rebuilt_x_train, y_train)
-
-                y_pred = model.predict(rebuilt_x_test)
-                accuracy = accuracy_score(y_test_full, y_pred)
-                self.accuracy_dict_entire_test_set[method] = accuracy
-
-                rebuilt_x_missing = pd.DataFrame(x_missing, columns = labels_C)
-                rebuilt_x_missing = rebuilt_x_missing.drop(columns = self.columns_missing, axis = 1)
-                y_pred_missing = model.predict(rebuilt_x_missing)
-                accuracy_missing = accuracy_score(y_missing, y_pred_missing)
-                self.accuracy_dict_missing_values[method] = accuracy_missing
-
-                print("Method C suceeded")
-
-            if method == 'D': #mean imputation
-
-                feature_labels = self.feature_labels.copy()
-                rebuilt_x_missing = pd.DataFrame(x_missing, columns = feature_labels)
-                x_train = self.x_train.copy()
-                rebuilt_x_train = pd.DataFrame(x_train, columns = feature_labels)
-                mean_feature_dict = {}
-
-                for column in self.columns_missing:
-
-                    mean_feature_dict[column] = rebuilt_x_train[column].mean() #get the mean of each column
-
-                for column in mean_feature_dict:
-
-                    rebuilt_x_missing[column] = rebuilt_x_missing[column].fillna(mean_feature_dict[column]) #fill the null values with the mean
-
-                x_test_full = np.concatenate((x_test, rebuilt_x_missing))
-                y_test_full = np.concatenate((y_test, y_missing))
-
-                y_pred = self.model.predict(x_test_full)
-                accuracy = accuracy_score(y_test_full, y_pred)
-                self.accuracy_dict_entire_test_set[method] = accuracy
-
-                y_pred_missing = self.model.predict(rebuilt_x_missing.values)
-                accuracy_missing = accuracy_score(y_missing, y_pred_missing)
-                self.accuracy_dict_missing_values[method] = accuracy_missing
+    def _eval_A(self): #method: Abstention
 
-                print("Method D succeeded")
-            
-            if method == 'E': #median imputation
+        y_pred = self.y_pred_test
+        num_missing_items = self.x_missing.shape[0]
+        y_pred_missing = np.full((num_missing_items,), -1)
+        y_pred_full = np.concatenate((y_pred, y_pred_missing))
+    
+        accuracy = accuracy_score(self.y_test_full, y_pred_full)
 
-                feature_labels = self.feature_labels.copy()
-                rebuilt_x_missing = pd.DataFrame(x_missing, columns = feature_labels)
-                x_train = self.x_train.copy()
-                rebuilt_x_train = pd.DataFrame(x_train, columns = feature_labels)
-                median_feature_dict = {}
+        #because items with missing values are treated as errors, we can ignore it and give it a 0.0 accuracy
+        missing_items_array = np.full((num_missing_items, ), -1) 
+        accuracy_missing = accuracy_score(self.y_missing, missing_items_array)
 
-                for column in self.columns_missing:
+        return accuracy, accuracy_missing
 
-                    median_feature_dict[column] = rebuilt_x_train[column].median() #we're doing the same as D but we're using medians
-
-                for column in median_feature_dict:
-
-                    rebuilt_x_missing[column] = rebuilt_x_missing[column].fillna(median_feature_dict[column])
-
-                x_test_full = np.concatenate((x_test, rebuilt_x_missing))
-                y_test_full = np.concatenate((y_test, y_missing))
-
-                y_pred = self.model.predict(x_test_full)
-                accuracy = accuracy_score(y_test_full, y_pred)
-                self.accuracy_dict_entire_test_set[method] = accuracy
-
-                y_pred_missing = self.model.predict(rebuilt_x_missing.values)
-                accuracy_missing = accuracy_score(y_missing, y_pred_missing)
-                self.accuracy_dict_missing_values[method] = accuracy_missing
-
-                print("Method E succeeded")
-
-            if method == 'F': #KNN imputation
-                
-                x_train = self.x_train.copy()
-                y_test_full = np.concatenate((y_test, y_missing))
-                knn_imputer = KNNImputer(n_neighbors = 30)
-                knn_imputer.fit(x_train)
-                x_missing_imputed = knn_imputer.transform(x_missing)
-                x_test_full = np.concatenate((x_test, x_missing_imputed))
-                y_pred = self.model.predict(x_test_full)
-                accuracy = accuracy_score(y_test_full, y_pred)
-                self.accuracy_dict_entire_test_set[method] = accuracy
-
-                y_pred_missing = self.model.predict(x_missing_imputed)
-                accuracy_missing = accuracy_score(y_missing, y_pred_missing)
-                self.accuracy_dict_missing_values[method] = accuracy_missing
-
-                print("Method F succeeded")
-
-            else:
-                continue
-        
-        
-
-
-
-
-                    
+    def _eval_B(self): #majority inference
 
+        #create a new np array that is of dimension y_missing but filled with the majority class label
+        y_pred_majority = np.full_like(self.y_missing, fill_value = self.majority_class) 
+        y_pred_non_missing = self.y_pred_test
+        y_pred = np.concatenate((y_pred_non_missing, y_pred_majority))
+        accuracy = accuracy_score(self.y_test_full, y_pred)
 
+        #missing only now
+        #we compare y_pred_majority predictions with y_missing
+        accuracy_missing = accuracy_score(self.y_missing, y_pred_majority)
 
+        return accuracy, accuracy_missing
 
+    def _eval_C(self):
+    # omit any features with missing values (based on report generated, the features to be eliminated should be
+    # )
+        rebuilt_x_test = np.concatenate((self.x_test, self.x_missing))[:, self.keep_col_idx] #omitting features with missing values here from the testing set
+        rebuilt_x_train = self.x_train[:, self.keep_col_idx] #omitting from training set
+        model = RandomForestClassifier(random_state = self.random_seed, n_jobs = -1) #built here so each worker owns its model
+        model.fit(rebuilt_x_train, self.y_train)
 
+        y_pred = chunked_predict(model, rebuilt_x_test)
+        accuracy = accuracy_score(self.y_test_full, y_pred)
 
+        rebuilt_x_missing = self.x_missing[:, self.keep_col_idx]
+        y_pred_missing = chunked_predict(model, rebuilt_x_missing)
+        accuracy_missing = accuracy_score(self.y_missing, y_pred_missing)
 
+        return accuracy, accuracy_missing
 
+    def _impute_missing(self, statistic):
 
+        #only the columns with missing values ever get used from this row, the rest stay 0
+        fill_values = np.zeros(self.x_missing.shape[1], dtype = self.x_missing.dtype)
+        fill_values[self.missing_col_idx] = statistic(self.x_train[:, self.missing_col_idx], axis = 0) #one pass over every column with missing values
 
+        return np.where(np.isnan(self.x_missing), fill_values[None, :], self.x_missing) #fill the null values with the statistic of their column
 
+    def _eval_D(self): #mean imputation
 
+        rebuilt_x_missing = self._impute_missing(np.nanmean)
+        y_pred_missing = chunked_predict(self.model, rebuilt_x_missing) #only the imputed items need a fresh prediction
+        y_pred = np.concatenate((self.y_pred_test, y_pred_missing))
+        accuracy = accuracy_score(self.y_test_full, y_pred)
 
+        accuracy_missing = accuracy_score(self.y_missing, y_pred_missing)
 
+        return accuracy, accuracy_missing
 
+    def _eval_E(self): #median imputation
 
+        rebuilt_x_missing = self._impute_missing(np.nanmedian) #we're doing the same as D but we're using medians
+        y_pred_missing = chunked_predict(self.model, rebuilt_x_missing) #only the imputed items need a fresh prediction
+        y_pred = np.concatenate((self.y_pred_test, y_pred_missing))
+        accuracy = accuracy_score(self.y_test_full, y_pred)
 
+        accuracy_missing = accuracy_score(self.y_missing, y_pred_missing)
 
+        return accuracy, accuracy_missing
 
+    def _eval_F(self): #KNN imputation
 
+        x_missing_imputed = cached_knn_impute(self.x_train, self.x_missing, n_neighbors = 30)
+        y_pred_missing = chunked_predict(self.model, x_missing_imputed) #only the imputed items need a fresh prediction
+        y_pred = np.concatenate((self.y_pred_test, y_pred_missing))
+        accuracy = accuracy_score(self.y_test_full, y_pred)
 
+        accuracy_missing = accuracy_score(self.y_missing, y_pred_missing)
 
+        return accuracy, accuracy_missing
 
+    def evaluate_model(self):
 
-                
+        methods = ('A','B','C','D','E','F')
+        self.y_test_full = np.concatenate((self.y_test, self.y_missing)) #truth labels of the entire test set, shared by every method
+        self.y_pred_test = chunked_predict(self.model, self.x_test) #x_test is the same for every method, so predict it only once
+        dispatch = {'A': self._eval_A, 'B': self._eval_B, 'C': self._eval_C, 'D': self._eval_D, 'E': self._eval_E, 'F': self._eval_F}
 
+        #the methods only read the shared arrays and the trained model, so they can run side by side. threads are used
+        #so the data and the model do not have to be pickled over to worker processes
+        results = Parallel(n_jobs = len(methods), prefer = "threads")(delayed(dispatch[m])() for m in methods)
 
+        for m, (accuracy, accuracy_missing) in zip(methods, results):
 
+            self.accuracy_dict_entire_test_set[m] = accuracy
+            self.accuracy_dict_missing_values[m] = accuracy_missing
+            print("Method " + m + " succeeded")